@@ -1,53 +1,143 @@
 """
 AI-Powered Diagnosis Engine using OpenRouter (Official API)
 """
+import asyncio
+import hashlib
+import re
 import requests
-import json
 import logging
+import threading
+import random
+import numpy as np
+import orjson
+import tiktoken
+from requests.adapters import HTTPAdapter
+from diagnostic_engine import DiagnosisAggregator, YTDoc
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
-class AIDiagnosticEngine:
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.base_url = "https://openrouter.ai/api/v1/chat/completions"
-    
-    def analyze_with_all_sources(self, vehicle_info, sound_location, audio_features, youtube_data=None, enhanced_context=None):
-        """
-        Use GPT-4 via OpenRouter to analyze ALL collected data sources
-        
-        Args:
-            vehicle_info: Vehicle details
-            sound_location: Where sound is coming from
-            audio_features: Audio analysis metrics
-            youtube_data: Dict with titles, descriptions, comments, transcripts from 15 videos
-            enhanced_context: User's description and context
-        """
-        try:
-            context = self._build_comprehensive_context(
-                vehicle_info, 
-                sound_location, 
-                audio_features, 
-                youtube_data, 
-                enhanced_context
-            )
-            
-            logger.info("🤖 Sending comprehensive data to GPT-4 for analysis...")
-            
-            response = requests.post(
-                url=self.base_url,
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "HTTP-Referer": "https://autodecx.app",
-                    "X-Title": "AutoDecx",
-                    "Content-Type": "application/json"
-                },
-                data=json.dumps({
-                    "model": "openai/gpt-4o",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": """You are an expert automotive diagnostic technician with 20+ years experience.
+# Maximum number of diagnoses sent to OpenRouter at once by analyze_many
+MAX_BATCH_SIZE = 16
+
+# Diagnosis cache sizing - bump PROMPT_VERSION whenever a system prompt changes
+PROMPT_VERSION = "v2"
+CACHE_MAX_SIZE = 4096
+CACHE_TTL_SECONDS = 3600
+
+# Token budgets for each YouTube excerpt in the prompt context
+TITLE_TOKEN_BUDGET = 20
+DESCRIPTION_TOKEN_BUDGET = 60
+COMMENT_TOKEN_BUDGET = 40
+TRANSCRIPT_TOKEN_BUDGET = 120
+CHARS_PER_TOKEN = 4  # Fallback estimate when the tokenizer can't be loaded
+HEAD_CHARS_PER_TOKEN = 16  # Generous window for encoding just a document's head
+
+SOURCE_TOKEN_BUDGETS = {
+    'titles': TITLE_TOKEN_BUDGET,
+    'descriptions': DESCRIPTION_TOKEN_BUDGET,
+    'comments': COMMENT_TOKEN_BUDGET,
+    'transcripts': TRANSCRIPT_TOKEN_BUDGET,
+}
+
+# youtube_data lists converted to YTDoc records by prepare_youtube_data
+YOUTUBE_TEXT_SOURCES = ('titles', 'descriptions', 'comments', 'transcripts')
+
+# Links, timestamps and channel plugs carry no diagnostic signal but cost tokens
+BOILERPLATE_RE = re.compile(r"https?://\S+|\d{1,2}:\d{2}(?::\d{2})?|subscribe.*?channel", re.I)
+
+AUDIO_ANALYSIS_TEMPLATE = (
+    "\nAUDIO ANALYSIS:\n"
+    "- Dominant Frequency: %.0f Hz\n"
+    "- Vibration Level (RMS): %.3f\n"
+    "- Zero Crossing Rate: %.3f\n"
+    "- Spectral Bandwidth: %.0f Hz\n"
+    "- Spectral Rolloff: %.0f Hz"
+)
+
+# OpenRouter retries - jittered exponential backoff on transient failures
+RETRY_MAX_ATTEMPTS = 5
+RETRY_INITIAL_DELAY = 1.0
+RETRY_MAX_DELAY = 16.0
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# Overall budget for one call including retries; each attempt's timeout shrinks to fit it
+RETRY_DEADLINE_SECONDS = 45.0
+REQUEST_TIMEOUT = 20
+RETRY_MIN_TIMEOUT = 2.0
+
+# Model cascade - re-ask the verifier model below either threshold
+VERIFY_BELOW_SELF_CONFIDENCE = 0.7
+VERIFY_BELOW_DATA_CONFIDENCE = 80
+
+# Skip the LLM entirely when the keyword aggregator already agrees with itself this strongly
+CONSENSUS_SHORT_CIRCUIT = 0.75
+CONSENSUS_MIN_MENTIONS = 6  # Weighted keyword mentions needed before trusting the consensus
+CONSENSUS_CONFIDENCE_CAP = 80  # Keyword-only answers never outrank an AI diagnosis's confidence
+
+# Canned diagnoses for high-consensus cases, in the SYSTEM_PROMPT answer format. Only
+# specific components: location words (engine, exhaust, ...) come from the search query.
+REPAIR_TEMPLATES = {
+    'brake': "Brake wear - Inspect pads and rotors, replace pads and resurface or replace rotors as needed. Squeal or grinding usually means the wear indicators are contacting.",
+    'pad': "Brake pad wear - Replace brake pads and inspect rotors for scoring. Common when pads reach their wear indicators.",
+    'rotor': "Warped or scored brake rotors - Resurface or replace rotors and fit new pads. Often felt as pulsing through the pedal.",
+    'caliper': "Sticking brake caliper - Service or replace the caliper and slide pins. Usually causes pulling and a hot wheel after driving.",
+    'bearing': "Wheel bearing failure - Replace the affected wheel bearing/hub assembly. Hum or growl that changes with speed and load in turns.",
+    'belt': "Drive belt wear - Replace the belt and check tensioner and pulleys. Squeal on startup or under accessory load is typical.",
+    'serpentine': "Serpentine belt wear - Replace the serpentine belt and inspect the tensioner. Chirp or squeal on startup is typical.",
+    'timing chain': "Timing chain stretch - Replace timing chain, guides and tensioner. Rattle on cold start is the classic symptom.",
+    'timing belt': "Timing belt wear - Replace timing belt, tensioner and water pump together. Failure can cause engine damage on interference engines.",
+    'muffler': "Muffler failure - Replace the muffler and check hangers. Rumble or rattle from the rear of the car is typical.",
+    'catalytic converter': "Catalytic converter failure - Replace the converter and check for the cause. Rattle underneath usually means a broken substrate.",
+    'manifold': "Exhaust manifold leak - Replace the gasket or cracked manifold. Ticking on cold start that fades as it warms up is typical.",
+    'shock': "Worn shock absorbers - Replace shocks in pairs. Bouncing and knocking over bumps are typical.",
+    'strut': "Worn struts - Replace struts and strut mounts in pairs. Clunks over bumps and while turning are typical.",
+    'strut mount': "Strut mount failure - Replace strut mounts and bearings. Clunk or creak when turning the steering is typical.",
+    'clutch': "Clutch wear - Inspect the release bearing and clutch assembly and replace as needed. Noise that changes with pedal position is typical.",
+    'turbo': "Turbocharger issue - Inspect for boost leaks and turbo shaft play. Whistle or whine under boost is typical.",
+    'alternator': "Alternator bearing failure - Replace the alternator. Whine that rises with RPM and charging issues are typical.",
+    'starter': "Starter failure - Replace the starter motor or solenoid. Grinding or clicking when cranking is typical.",
+    'pulley': "Pulley bearing failure - Replace the noisy idler or tensioner pulley. Chirp or whine from the belt drive is typical.",
+    'idler': "Idler pulley failure - Replace the idler pulley. Chirp or whine from the belt drive is typical.",
+    'tensioner': "Belt tensioner failure - Replace the tensioner and inspect the belt. Rattle or chirp from the belt drive is typical.",
+    'mount': "Worn engine or transmission mount - Replace the worn mount. Clunks on acceleration and shifting are typical.",
+    'cv joint': "CV joint wear - Replace the CV axle. Clicking while turning under power is the classic symptom.",
+    'cv axle': "CV axle wear - Replace the CV axle. Clicking while turning under power is the classic symptom.",
+    'tire': "Tire wear or damage - Inspect tires for uneven wear and rotate, balance or replace as needed. Hum that changes with road surface is typical.",
+    'misfire': "Engine misfire - Scan for codes and check spark plugs and ignition coils. Rough idle and shaking are typical.",
+    'spark plug': "Worn spark plugs - Replace spark plugs and inspect coils. Misfire and rough idle are typical.",
+    'ball joint': "Worn ball joint - Replace the ball joint. Clunks over bumps and vague steering are typical.",
+    'tie rod': "Worn tie rod end - Replace the tie rod end and align the wheels. Loose steering and clunks are typical.",
+    'control arm': "Worn control arm bushings - Replace the control arm or bushings. Clunks over bumps and braking are typical.",
+    'sway bar': "Worn sway bar links or bushings - Replace sway bar links and bushings. Clunks over uneven roads are typical.",
+    'power steering': "Power steering issue - Check fluid level and inspect the pump. Whine while turning the wheel is typical.",
+    'vanos': "VANOS issue - Inspect the VANOS solenoids and unit seals. Rattle on startup and rough idle are typical.",
+}
+
+# Confidence scoring: base score plus the weight of every rule that holds, capped.
+# Rules use & rather than chained comparisons so they also work on numpy arrays.
+CONFIDENCE_BASE = 70
+CONFIDENCE_CAP = 95
+CONFIDENCE_RULES = (
+    (lambda f: f['rms_energy'] > 0.05, 5),                                        # Good audio signal
+    (lambda f: (f['zero_crossing_rate'] > 0.05) & (f['zero_crossing_rate'] < 0.4), 5),  # Normal pattern
+    (lambda f: f['num_videos'] >= 10, 10),                                        # Excellent data
+    (lambda f: (f['num_videos'] >= 5) & (f['num_videos'] < 10), 7),               # Good data
+    (lambda f: (f['num_videos'] >= 1) & (f['num_videos'] < 5), 3),                # Some data
+    (lambda f: f['has_comments'], 3),
+    (lambda f: f['has_transcripts'], 3),
+    (lambda f: f['similarity'] > 0.7, 5),                                         # Good audio match
+    (lambda f: (f['similarity'] > 0.5) & (f['similarity'] <= 0.7), 3),
+    (lambda f: f['has_description'], 3),
+    (lambda f: f['has_occurrence'], 2),
+)
+
+# Micro-batching for streamed diagnoses - flush after this many deltas AND seconds
+STREAM_MIN_TOKENS = 8
+STREAM_FLUSH_INTERVAL = 0.05
+
+SYSTEM_PROMPT = """You are an expert automotive diagnostic technician with 20+ years experience.
 
 You will receive data from MULTIPLE sources:
 1. Audio frequency analysis (dominant frequency, vibration levels, patterns)
@@ -71,56 +161,638 @@ Format: [Component] failure - [Repair action]. [Additional technical context]
 Example: "Brake pad wear with glazed rotors - Replace brake pads and resurface rotors. Common when pads reach wear indicators."
 
 Be specific and actionable. Max 250 characters."""
-                        },
-                        {
-                            "role": "user",
-                            "content": context
-                        }
-                    ],
-                    "temperature": 0.3,
-                    "max_tokens": 150
-                }),
-                timeout=20
-            )
+
+# Appended for the primary model, which answers in JSON mode with a self-rating
+PROPOSAL_FORMAT_PROMPT = """
+
+Respond ONLY with a JSON object of the form:
+{"diagnosis": "<diagnosis in the format above>", "self_confidence": <0.0-1.0, how sure you are>}"""
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """Load the gpt-4o tokenizer once per process (None if it can't be loaded)"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    _encoding = tiktoken.encoding_for_model("gpt-4o")
+                except Exception as e:
+                    # tiktoken fetches its BPE file on first use - don't fail diagnoses over it
+                    logger.warning(f"Tokenizer unavailable, truncating by characters: {str(e)}")
+                _encoding_loaded = True
+    return _encoding
+
+
+def _clean_text(text):
+    """Strip links, timestamps and channel plugs and collapse whitespace"""
+    return ' '.join(BOILERPLATE_RE.sub(' ', text).split())
+
+
+def _truncate_tokens(text, max_tokens):
+    """Strip boilerplate from text and cut it to at most max_tokens gpt-4o tokens"""
+    if not text:
+        return ""
+    
+    text = _clean_text(text)
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    
+    # Comments are user text - treat "<|endoftext|>" and friends as plain text
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    
+    # A cut can land inside a multi-byte character; drop the replacement char
+    return encoding.decode(tokens[:max_tokens]).rstrip('\ufffd')
+
+
+def _excerpt(item, max_tokens):
+    """Token-bounded excerpt of a YouTube string or YTDoc (reusing its ingest tokens)"""
+    if isinstance(item, YTDoc):
+        if not item.tokens:
+            return _truncate_tokens(item.text, max_tokens)
+        return _get_encoding().decode(item.tokens[:max_tokens]).rstrip('\ufffd')
+    
+    return _truncate_tokens(item, max_tokens)
+
+
+def _encode_head(encoding, text, max_tokens):
+    """
+    Encode only as much of text as the first max_tokens tokens need
+    
+    Long transcripts are cut to a character window before encoding, so memory
+    and tokenizer work stay proportional to the budget rather than the video.
+    """
+    head = text[:max_tokens * HEAD_CHARS_PER_TOKEN]
+    tokens = encoding.encode(head, disallowed_special=())
+    
+    # The window's last word may split differently than in the full text, which
+    # only matters if the window produced no more tokens than the budget
+    if len(tokens) <= max_tokens and len(head) < len(text):
+        tokens = encoding.encode(text, disallowed_special=())
+    
+    return tokens[:max_tokens]
+
+
+def _backoff_delay(attempt):
+    """Exponential backoff for the given 1-based attempt, plus up to a second of jitter"""
+    delay = RETRY_INITIAL_DELAY * (2 ** (attempt - 1)) + random.uniform(0, 1)
+    return min(delay, RETRY_MAX_DELAY)
+
+
+def _retry_after_seconds(response):
+    """Seconds requested by a Retry-After header (capped at RETRY_MAX_DELAY), or None"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return min(max(float(value), 0.0), RETRY_MAX_DELAY)
+    except ValueError:
+        return None  # HTTP-date form - fall back to our own backoff
+
+
+def _format_template(top_keyword):
+    """Canned repair text for the aggregator's top keyword (None if it names no known component)"""
+    template = REPAIR_TEMPLATES.get(top_keyword)
+    if template is None:
+        template = REPAIR_TEMPLATES.get(top_keyword.rstrip('s'))
+    return template
+
+
+def prepare_youtube_data(youtube_data):
+    """
+    Turn youtube_data text lists into YTDoc records once at ingest
+    
+    Each document is lowercased, keyword-scanned and tokenized a single time,
+    keeping only the tokens its context budget can use; pass the result to both
+    DiagnosisAggregator.aggregate_diagnoses and AIDiagnosticEngine so neither
+    re-processes the raw strings.
+    
+    Args:
+        youtube_data: Dict with titles, descriptions, comments, transcripts lists
+        
+    Returns:
+        Copy of youtube_data with those lists converted to YTDoc records
+    """
+    if not youtube_data:
+        return youtube_data
+    
+    encoding = _get_encoding()
+    prepared = dict(youtube_data)
+    
+    for source in YOUTUBE_TEXT_SOURCES:
+        if source not in youtube_data:
+            continue
+        
+        docs = []
+        for i, item in enumerate(youtube_data[source] or []):
+            if isinstance(item, YTDoc):
+                docs.append(item)
+                continue
             
-            if response.status_code == 200:
-                result = response.json()
-                diagnosis_text = result['choices'][0]['message']['content'].strip()
-                
+            tokens = None
+            if item and encoding is not None:
+                tokens = _encode_head(encoding, _clean_text(item), SOURCE_TOKEN_BUDGETS[source])
+            docs.append(YTDoc.from_text(f"{source}-{i}", item, tokens))
+        prepared[source] = docs
+    
+    return prepared
+
+
+def _confidence_inputs(audio_features, youtube_data, enhanced_context):
+    """Flatten the data-availability signals CONFIDENCE_RULES score"""
+    audio_features = audio_features or {}
+    youtube_data = youtube_data or {}
+    enhanced_context = enhanced_context or {}
+    best_match = youtube_data.get('best_match') or {}
+    
+    return {
+        'rms_energy': audio_features.get('rms_energy', 0),
+        'zero_crossing_rate': audio_features.get('zero_crossing_rate', 0),
+        'num_videos': len(youtube_data.get('titles', [])),
+        'has_comments': bool(youtube_data.get('comments')),
+        'has_transcripts': bool(youtube_data.get('transcripts')),
+        'similarity': best_match.get('similarity', 0),
+        'has_description': bool(enhanced_context.get('audio_description')),
+        'has_occurrence': bool(enhanced_context.get('occurrence')),
+    }
+
+
+class DiagnosisCache:
+    """Thread-safe LRU cache with per-entry expiry for AI diagnoses"""
+    
+    def __init__(self, maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used entry when full"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared across engine instances so every request in a worker benefits
+_diagnosis_cache = DiagnosisCache()
+
+
+class AIDiagnosticEngine:
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.base_url = "https://openrouter.ai/api/v1/chat/completions"
+        # Cheap model proposes, full model verifies only when the proposal is shaky
+        self.primary_model = "openai/gpt-4o-mini"
+        self.verifier_model = "openai/gpt-4o"
+        
+        # Keep-alive connection pool so repeat calls skip the TCP+TLS handshake
+        self.session = requests.Session()
+        # Retries are handled by _post_with_retry so they aren't compounded here
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=64
+        ))
+        self.session.headers.update(self._build_headers())
+    
+    def analyze_with_all_sources(self, vehicle_info, sound_location, audio_features, youtube_data=None, enhanced_context=None, data_confidence=None):
+        """
+        Use GPT-4 via OpenRouter to analyze ALL collected data sources
+        
+        Args:
+            vehicle_info: Vehicle details
+            sound_location: Where sound is coming from
+            audio_features: Audio analysis metrics
+            youtube_data: Dict with titles, descriptions, comments, transcripts from 15 videos
+            enhanced_context: User's description and context
+            data_confidence: Precomputed _calculate_comprehensive_confidence score (optional)
+        """
+        try:
+            if data_confidence is None:
                 # Calculate confidence based on data availability
-                confidence = self._calculate_comprehensive_confidence(
+                data_confidence = self._calculate_comprehensive_confidence(
                     audio_features, 
                     youtube_data, 
                     enhanced_context
                 )
+            
+            context = self._build_comprehensive_context(
+                vehicle_info, 
+                sound_location, 
+                audio_features, 
+                youtube_data, 
+                enhanced_context
+            )
+            
+            cache_key = self._cache_key(context)
+            diagnosis_text = _diagnosis_cache.get(cache_key)
+            
+            if diagnosis_text is not None:
+                logger.info("⚡ Reusing cached AI diagnosis for identical context")
+            else:
+                diagnosis_text = self._run_cascade(context, data_confidence)
+                if not diagnosis_text:
+                    return None
                 
-                sources_used = []
-                if audio_features:
-                    sources_used.append("Audio analysis")
-                if youtube_data:
-                    sources_used.append(f"{len(youtube_data.get('titles', []))} YouTube videos")
-                    if youtube_data.get('comments'):
-                        sources_used.append(f"{len(youtube_data['comments'])} comments")
-                    if youtube_data.get('transcripts'):
-                        sources_used.append(f"{len(youtube_data['transcripts'])} transcripts")
-                if enhanced_context and enhanced_context.get('audio_description'):
-                    sources_used.append("User description")
-                
-                logger.info(f"✅ AI Diagnosis (from {len(sources_used)} sources): {diagnosis_text}")
+                # Cached per context, so a verifier answer also serves later mini-path hits
+                _diagnosis_cache.set(cache_key, diagnosis_text)
+            
+            return self._build_result(diagnosis_text, data_confidence, audio_features, youtube_data, enhanced_context)
                 
-                return {
-                    'diagnosis': diagnosis_text,
-                    'confidence': confidence,
-                    'ai_generated': True,
-                    'sources_used': sources_used
-                }
+        except Exception as e:
+            logger.error(f"AI diagnosis error: {str(e)}")
+            return None
+    
+    def diagnose(self, vehicle_info, sound_location, audio_features, youtube_data=None, enhanced_context=None, spectrogram_match=None):
+        """
+        Diagnose from all sources, skipping the LLM when the keyword aggregate is unambiguous
+        
+        Args:
+            vehicle_info: Vehicle details
+            sound_location: Where sound is coming from
+            audio_features: Audio analysis metrics
+            youtube_data: Dict with titles, descriptions, comments, transcripts
+            enhanced_context: User's description and context
+            spectrogram_match: Best spectrogram match diagnosis (optional)
+            
+        Returns:
+            dict: Same shape as analyze_with_all_sources (None if the AI call failed)
+        """
+        youtube_data = youtube_data or {}
+        aggregate = DiagnosisAggregator.aggregate_diagnoses(
+            youtube_titles=youtube_data.get('titles'),
+            youtube_descriptions=youtube_data.get('descriptions'),
+            youtube_comments=youtube_data.get('comments'),
+            youtube_transcripts=youtube_data.get('transcripts'),
+            spectrogram_match=spectrogram_match,
+            vehicle_info=vehicle_info
+        )
+        
+        # The search query always contains the location and vehicle, so those words
+        # echo back from every result; judge consensus on the remaining keywords only
+        query_text = ' '.join(str(v) for v in (sound_location, *(vehicle_info or {}).values()) if v).lower()
+        keyword_counts = aggregate.get('keyword_counts', {})
+        echoed = sum(count for keyword, count in keyword_counts.items() if keyword in query_text)
+        candidates = [(k, keyword_counts[k]) for k in aggregate['keywords'] if k not in query_text]
+        mentions = aggregate.get('total_mentions', 0) - echoed
+        
+        # Only skip the LLM on strong, well-supported agreement about a component we
+        # have canned repair text for; symptom words like 'worn' or 'leaking' fall through
+        top_keyword, top_count = candidates[0] if candidates else (None, 0)
+        template = _format_template(top_keyword) if top_keyword else None
+        share = top_count / mentions if mentions > 0 else 0.0
+        
+        if template and share >= CONSENSUS_SHORT_CIRCUIT and mentions >= CONSENSUS_MIN_MENTIONS:
+            logger.info(f"⚡ Sources agree on '{top_keyword}' ({share:.0%} of {mentions} mentions), skipping AI call")
+            return {
+                'diagnosis': template,
+                'confidence': min(CONSENSUS_CONFIDENCE_CAP, round(share * 100)),
+                'ai_generated': False,
+                'sources_used': aggregate['sources']
+            }
+        
+        return self.analyze_with_all_sources(vehicle_info, sound_location, audio_features, youtube_data, enhanced_context)
+    
+    def _build_result(self, diagnosis_text, confidence, audio_features, youtube_data, enhanced_context):
+        """Wrap diagnosis text with confidence and the list of sources used"""
+        sources_used = []
+        if audio_features:
+            sources_used.append("Audio analysis")
+        if youtube_data:
+            sources_used.append(f"{len(youtube_data.get('titles', []))} YouTube videos")
+            if youtube_data.get('comments'):
+                sources_used.append(f"{len(youtube_data['comments'])} comments")
+            if youtube_data.get('transcripts'):
+                sources_used.append(f"{len(youtube_data['transcripts'])} transcripts")
+        if enhanced_context and enhanced_context.get('audio_description'):
+            sources_used.append("User description")
+        
+        logger.info(f"✅ AI Diagnosis (from {len(sources_used)} sources): {diagnosis_text}")
+        
+        return {
+            'diagnosis': diagnosis_text,
+            'confidence': confidence,
+            'ai_generated': True,
+            'sources_used': sources_used
+        }
+    
+    async def analyze_with_all_sources_async(self, vehicle_info, sound_location, audio_features, youtube_data=None, enhanced_context=None):
+        """
+        Async variant of analyze_with_all_sources for callers running an event loop.
+        
+        The blocking OpenRouter round trip runs in a worker thread so the loop
+        can overlap it with other diagnoses.
+        """
+        return await asyncio.to_thread(
+            self.analyze_with_all_sources,
+            vehicle_info,
+            sound_location,
+            audio_features,
+            youtube_data,
+            enhanced_context
+        )
+    
+    def stream_with_all_sources(self, vehicle_info, sound_location, audio_features, youtube_data=None, enhanced_context=None):
+        """
+        Stream the diagnosis as OpenRouter decodes it (e.g. for an SSE response)
+        
+        Partial text is flushed in micro-batches of at least STREAM_MIN_TOKENS
+        deltas and STREAM_FLUSH_INTERVAL seconds, so callers aren't woken per token.
+        
+        Yields:
+            {'diagnosis': text_so_far, 'partial': True} while decoding, then the
+            full analyze_with_all_sources result with 'partial': False. On failure
+            (HTTP error, empty stream or exception) the last item is instead
+            {'error': message, 'partial': False}, so the stream always terminates
+        """
+        try:
+            context = self._build_comprehensive_context(
+                vehicle_info, 
+                sound_location, 
+                audio_features, 
+                youtube_data, 
+                enhanced_context
+            )
+            
+            cache_key = self._cache_key(context)
+            diagnosis_text = _diagnosis_cache.get(cache_key)
+            
+            if diagnosis_text is not None:
+                logger.info("⚡ Reusing cached AI diagnosis for identical context")
             else:
-                logger.error(f"OpenRouter error: {response.status_code} - {response.text}")
-                return None
+                logger.info("🤖 Streaming comprehensive data to GPT-4 for analysis...")
+                
+                response = self._post_with_retry(
+                    orjson.dumps(self._build_payload(context, self.verifier_model, stream=True)),
+                    stream=True
+                )
                 
+                with response:
+                    if response.status_code != 200:
+                        logger.error(f"OpenRouter error: {response.status_code} - {response.text}")
+                        yield {'error': f"OpenRouter error: {response.status_code}", 'partial': False}
+                        return
+                    
+                    chunks = []
+                    pending = 0
+                    last_flush = time.monotonic()
+                    
+                    for delta in self._iter_stream_deltas(response):
+                        chunks.append(delta)
+                        pending += 1
+                        
+                        now = time.monotonic()
+                        if pending >= STREAM_MIN_TOKENS and now - last_flush >= STREAM_FLUSH_INTERVAL:
+                            yield {'diagnosis': ''.join(chunks), 'partial': True}
+                            pending = 0
+                            last_flush = now
+                
+                diagnosis_text = ''.join(chunks).strip()
+                if not diagnosis_text:
+                    logger.error("OpenRouter stream ended without content")
+                    yield {'error': "OpenRouter stream ended without content", 'partial': False}
+                    return
+                
+                _diagnosis_cache.set(cache_key, diagnosis_text)
+            confidence = self._calculate_comprehensive_confidence(
+                audio_features, 
+                youtube_data, 
+                enhanced_context
+            )
+            result = self._build_result(diagnosis_text, confidence, audio_features, youtube_data, enhanced_context)
+            result['partial'] = False
+            yield result
+            
         except Exception as e:
-            logger.error(f"AI diagnosis error: {str(e)}")
+            logger.error(f"AI diagnosis stream error: {str(e)}")
+            yield {'error': f"AI diagnosis stream error: {str(e)}", 'partial': False}
+    
+    def _iter_stream_deltas(self, response):
+        """Yield content deltas from an OpenRouter server-sent events response"""
+        # SSE is always UTF-8, but requests would decode a charset-less text/* body as
+        # ISO-8859-1; keep raw bytes and let orjson decode them
+        for line in response.iter_lines():
+            # Blank keep-alives and ": OPENROUTER PROCESSING" comments carry no data
+            if not line or not line.startswith(b'data: '):
+                continue
+            
+            data = line[len(b'data: '):]
+            if data == b'[DONE]':
+                break
+            
+            chunk = orjson.loads(data)
+            if not chunk.get('choices'):
+                continue
+            
+            delta = chunk['choices'][0].get('delta', {}).get('content')
+            if delta:
+                yield delta
+    
+    def analyze_many(self, cases, max_workers=MAX_BATCH_SIZE):
+        """
+        Run several diagnoses concurrently instead of one round trip at a time
+        
+        Args:
+            cases: List of dicts with analyze_with_all_sources keyword arguments
+                   (vehicle_info, sound_location, audio_features, youtube_data, enhanced_context)
+            max_workers: Maximum number of in-flight OpenRouter requests
+        
+        Returns:
+            List of diagnosis dicts (or None for failed cases), in input order
+        """
+        if not cases:
+            return []
+        
+        logger.info(f"🤖 Sending {len(cases)} diagnoses to GPT-4 concurrently...")
+        
+        # Score every case in one vectorized pass instead of per worker; if one case is
+        # malformed, let each worker score its own so only that case fails (to None)
+        try:
+            confidences = self._calculate_comprehensive_confidence_batch(cases)
+        except Exception as e:
+            logger.warning(f"Batch confidence scoring failed, scoring cases individually: {str(e)}")
+            confidences = [None] * len(cases)
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(cases))) as executor:
+            futures = [
+                executor.submit(self.analyze_with_all_sources, data_confidence=confidence, **case)
+                for case, confidence in zip(cases, confidences)
+            ]
+            return [future.result() for future in futures]
+    
+    def _cache_key(self, context):
+        """Hash the model, prompt version and context into a diagnosis cache key"""
+        key_source = f"{self.primary_model}>{self.verifier_model}\0{PROMPT_VERSION}\0{context}"
+        return hashlib.blake2b(key_source.encode('utf-8'), digest_size=16).digest()
+    
+    def _build_headers(self):
+        """Build OpenRouter request headers"""
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "HTTP-Referer": "https://autodecx.app",
+            "X-Title": "AutoDecx",
+            # Bodies are pre-serialized with orjson, so requests won't set this
+            "Content-Type": "application/json"
+        }
+    
+    def _build_payload(self, context, model, stream=False, json_mode=False):
+        """Build chat-completions payload for a diagnostic context"""
+        system_prompt = SYSTEM_PROMPT + PROPOSAL_FORMAT_PROMPT if json_mode else SYSTEM_PROMPT
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": context}
+            ],
+            "temperature": 0.3,
+            "max_tokens": 150
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        if stream:
+            payload["stream"] = True
+        return payload
+    
+    def _post_with_retry(self, body, stream=False):
+        """
+        POST to OpenRouter, retrying transient failures with jittered exponential backoff
+        
+        Connection errors, timeouts, 429 and 5xx are retried up to RETRY_MAX_ATTEMPTS times,
+        honouring Retry-After when the server sends one. Other 4xx responses are returned as-is.
+        Retries stop early once the next attempt would overrun RETRY_DEADLINE_SECONDS.
+        
+        Args:
+            body: Serialized JSON payload
+            stream: Whether to stream the response body
+            
+        Returns:
+            requests.Response: The last response received
+        """
+        deadline = time.monotonic() + RETRY_DEADLINE_SECONDS
+        
+        for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+            timeout = min(REQUEST_TIMEOUT, max(deadline - time.monotonic(), RETRY_MIN_TIMEOUT))
+            error = None
+            try:
+                response = self.session.post(
+                    url=self.base_url,
+                    data=body,
+                    timeout=timeout,
+                    stream=stream
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+                response = None
+                reason = str(e)
+                delay = _backoff_delay(attempt)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                reason = f"HTTP {response.status_code}"
+                delay = _retry_after_seconds(response)
+                if delay is None:
+                    delay = _backoff_delay(attempt)
+            
+            out_of_time = time.monotonic() + delay + RETRY_MIN_TIMEOUT > deadline
+            if attempt == RETRY_MAX_ATTEMPTS or out_of_time:
+                if out_of_time:
+                    logger.warning(f"⏱️ OpenRouter {reason}, giving up after {attempt} attempt(s): retry deadline reached")
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                response.close()
+            
+            logger.warning(f"⏳ OpenRouter {reason}, retrying in {delay:.1f}s (attempt {attempt}/{RETRY_MAX_ATTEMPTS})")
+            time.sleep(delay)
+    
+    def _request_completion(self, payload):
+        """POST a chat-completions payload and return the message text (None on HTTP error)"""
+        response = self._post_with_retry(orjson.dumps(payload))
+        
+        if response.status_code != 200:
+            logger.error(f"OpenRouter error: {response.status_code} - {response.text}")
+            return None
+        
+        result = orjson.loads(response.content)
+        return result['choices'][0]['message']['content'].strip()
+    
+    def _run_cascade(self, context, data_confidence):
+        """
+        Ask the primary model for a diagnosis and escalate to the verifier when unsure
+        
+        Args:
+            context: Prompt context from _build_comprehensive_context
+            data_confidence: Score from _calculate_comprehensive_confidence
+            
+        Returns:
+            String: Diagnosis text, or None if OpenRouter failed
+        """
+        if data_confidence < VERIFY_BELOW_DATA_CONFIDENCE:
+            # Thin evidence would fail verification anyway - skip the mini round trip
+            logger.info("🤖 Limited supporting data, sending straight to GPT-4o...")
+            return self._request_completion(self._build_payload(context, self.verifier_model))
+        
+        logger.info("🤖 Sending comprehensive data to GPT-4o-mini for analysis...")
+        proposal = self._parse_proposal(
+            self._request_completion(self._build_payload(context, self.primary_model, json_mode=True))
+        )
+        
+        if proposal is not None:
+            diagnosis_text, self_confidence = proposal
+            if self_confidence >= VERIFY_BELOW_SELF_CONFIDENCE:
+                return diagnosis_text
+            logger.info(f"🔁 GPT-4o-mini unsure (self-confidence {self_confidence:.2f}), verifying with GPT-4o...")
+        else:
+            logger.info("🔁 No usable GPT-4o-mini proposal, verifying with GPT-4o...")
+        
+        return self._request_completion(self._build_payload(context, self.verifier_model))
+    
+    def _parse_proposal(self, content):
+        """Parse the primary model's JSON reply into (diagnosis, self_confidence)"""
+        if not content:
+            return None
+        
+        try:
+            data = orjson.loads(content)
+            diagnosis_text = str(data['diagnosis']).strip()
+            self_confidence = float(data.get('self_confidence', 0))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Could not parse GPT-4o-mini proposal: {str(e)}")
+            return None
+        
+        if not diagnosis_text:
             return None
+        
+        return diagnosis_text, self_confidence
     
     def analyze_audio_features(self, vehicle_info, sound_location, audio_features, matched_video=None, enhanced_context=None):
         """
@@ -209,13 +881,15 @@ Bandwidth: {audio_features.get('spectral_bandwidth', 0):.0f} Hz"""
         context_parts.append(f"VEHICLE: {vehicle_info.get('year')} {vehicle_info.get('manufacturer')} {vehicle_info.get('model')}")
         context_parts.append(f"SOUND LOCATION: {sound_location}")
         
-        # Audio analysis data
-        context_parts.append("\nAUDIO ANALYSIS:")
-        context_parts.append(f"- Dominant Frequency: {audio_features.get('dominant_frequency', 0):.0f} Hz")
-        context_parts.append(f"- Vibration Level (RMS): {audio_features.get('rms_energy', 0):.3f}")
-        context_parts.append(f"- Zero Crossing Rate: {audio_features.get('zero_crossing_rate', 0):.3f}")
-        context_parts.append(f"- Spectral Bandwidth: {audio_features.get('spectral_bandwidth', 0):.0f} Hz")
-        context_parts.append(f"- Spectral Rolloff: {audio_features.get('spectral_rolloff', 0):.0f} Hz")
+        # Audio analysis data - look each metric up once and format in one pass
+        af = audio_features or {}
+        context_parts.append(AUDIO_ANALYSIS_TEMPLATE % (
+            af.get('dominant_frequency', 0),
+            af.get('rms_energy', 0),
+            af.get('zero_crossing_rate', 0),
+            af.get('spectral_bandwidth', 0),
+            af.get('spectral_rolloff', 0)
+        ))
         
         # User's description
         if enhanced_context:
@@ -241,14 +915,14 @@ Bandwidth: {audio_features.get('spectral_bandwidth', 0):.0f} Hz"""
             if youtube_data.get('titles'):
                 context_parts.append(f"\nYOUTUBE VIDEO TITLES ({len(youtube_data['titles'])} videos):")
                 for i, title in enumerate(youtube_data['titles'][:15], 1):
-                    context_parts.append(f"{i}. {title}")
+                    context_parts.append(f"{i}. {_excerpt(title, TITLE_TOKEN_BUDGET)}")
             
             # Add descriptions (condensed)
             if youtube_data.get('descriptions'):
                 context_parts.append(f"\nYOUTUBE VIDEO DESCRIPTIONS:")
                 for i, desc in enumerate(youtube_data['descriptions'][:10], 1):
-                    # Take first 200 chars of each description
-                    desc_excerpt = desc[:200] if desc else ""
+                    # Take first DESCRIPTION_TOKEN_BUDGET tokens of each description
+                    desc_excerpt = _excerpt(desc, DESCRIPTION_TOKEN_BUDGET)
                     if desc_excerpt:
                         context_parts.append(f"{i}. {desc_excerpt}...")
             
@@ -256,14 +930,14 @@ Bandwidth: {audio_features.get('spectral_bandwidth', 0):.0f} Hz"""
             if youtube_data.get('comments'):
                 context_parts.append(f"\nYOUTUBE COMMENTS ({len(youtube_data['comments'])} comments):")
                 for i, comment in enumerate(youtube_data['comments'][:15], 1):
-                    context_parts.append(f"- {comment[:150]}")
+                    context_parts.append(f"- {_excerpt(comment, COMMENT_TOKEN_BUDGET)}")
             
             # Add transcripts (condensed)
             if youtube_data.get('transcripts'):
                 context_parts.append(f"\nYOUTUBE VIDEO TRANSCRIPTS ({len(youtube_data['transcripts'])} transcripts):")
                 for i, transcript in enumerate(youtube_data['transcripts'][:5], 1):
-                    # Take first 300 chars of each transcript
-                    transcript_excerpt = transcript[:300] if transcript else ""
+                    # Take first TRANSCRIPT_TOKEN_BUDGET tokens of each transcript
+                    transcript_excerpt = _excerpt(transcript, TRANSCRIPT_TOKEN_BUDGET)
                     if transcript_excerpt:
                         context_parts.append(f"{i}. {transcript_excerpt}...")
             
@@ -288,47 +962,35 @@ Bandwidth: {audio_features.get('spectral_bandwidth', 0):.0f} Hz"""
         Returns:
             Integer: Confidence score (0-95)
         """
-        confidence = 70  # Base confidence
-        
-        # Audio features quality
-        if audio_features:
-            if audio_features.get('rms_energy', 0) > 0.05:
-                confidence += 5  # Good audio signal
-            if 0.05 < audio_features.get('zero_crossing_rate', 0) < 0.4:
-                confidence += 5  # Normal pattern
+        inputs = _confidence_inputs(audio_features, youtube_data, enhanced_context)
+        confidence = CONFIDENCE_BASE + sum(weight for rule, weight in CONFIDENCE_RULES if rule(inputs))
+        return min(confidence, CONFIDENCE_CAP)
+    
+    def _calculate_comprehensive_confidence_batch(self, cases):
+        """
+        Score many diagnosis cases at once with the same CONFIDENCE_RULES
         
-        # YouTube data availability
-        if youtube_data:
-            num_videos = len(youtube_data.get('titles', []))
-            if num_videos >= 10:
-                confidence += 10  # Excellent data
-            elif num_videos >= 5:
-                confidence += 7   # Good data
-            elif num_videos >= 1:
-                confidence += 3   # Some data
-            
-            # Bonus for comments and transcripts
-            if youtube_data.get('comments'):
-                confidence += 3
-            if youtube_data.get('transcripts'):
-                confidence += 3
+        Args:
+            cases: List of dicts with audio_features, youtube_data, enhanced_context
             
-            # Bonus for good audio match
-            if youtube_data.get('best_match'):
-                similarity = youtube_data['best_match'].get('similarity', 0)
-                if similarity > 0.7:
-                    confidence += 5
-                elif similarity > 0.5:
-                    confidence += 3
+        Returns:
+            List of integer confidence scores (0-95), in input order
+        """
+        if not cases:
+            return []
         
-        # User context quality
-        if enhanced_context:
-            if enhanced_context.get('audio_description'):
-                confidence += 3
-            if enhanced_context.get('occurrence'):
-                confidence += 2
+        rows = [
+            _confidence_inputs(case.get('audio_features'), case.get('youtube_data'), case.get('enhanced_context'))
+            for case in cases
+        ]
+        # One array per input, so every rule evaluates as a vectorized mask
+        inputs = {key: np.array([row[key] for row in rows]) for key in rows[0]}
+        
+        confidence = np.full(len(rows), CONFIDENCE_BASE)
+        for rule, weight in CONFIDENCE_RULES:
+            confidence += weight * rule(inputs)
         
-        return min(confidence, 95)  # Cap at 95%
+        return np.minimum(confidence, CONFIDENCE_CAP).tolist()
 
 
 
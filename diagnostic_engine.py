@@ -3,12 +3,83 @@ Comprehensive Diagnostic Engine
 Combines multiple data sources for accurate vehicle diagnosis
 """
 
+import functools
 import logging
 from collections import Counter
+from dataclasses import dataclass, field
 import re
+import ahocorasick
 
 logger = logging.getLogger(__name__)
 
+# Common diagnostic keywords (expanded with more specific components)
+DIAGNOSTIC_KEYWORDS = (
+    'brake', 'brakes', 'pad', 'pads', 'rotor', 'rotors', 'caliper',
+    'bearing', 'bearings', 'wheel bearing', 'hub bearing',
+    'belt', 'serpentine', 'serpentine belt', 'timing belt', 'timing chain',
+    'exhaust', 'muffler', 'catalytic converter', 'manifold',
+    'suspension', 'shock', 'shocks', 'strut', 'struts', 'strut mount',
+    'engine', 'motor', 'piston', 'cylinder',
+    'transmission', 'gearbox', 'clutch',
+    'turbo', 'turbocharger', 'wastegate', 'boost',
+    'alternator', 'starter', 'battery',
+    'pulley', 'idler', 'tensioner', 'timing chain tensioner',
+    'mount', 'engine mount', 'motor mount', 'transmission mount',
+    'cv joint', 'cv axle', 'axle', 'driveshaft',
+    'tire', 'tires', 'wheel',
+    'leak', 'leaking', 'fluid',
+    'worn', 'wear', 'damage', 'damaged',
+    'loose', 'broken', 'cracked',
+    'misfire', 'ignition', 'spark plug', 'coil',
+    'sway bar', 'ball joint', 'tie rod', 'control arm',
+    'power steering', 'rack and pinion', 'steering',
+    'vanos', 'variable valve timing', 'vvt'
+)
+
+# Aho-Corasick automaton over all keywords: one pass per document reports every
+# (possibly overlapping) keyword occurrence instead of ~70 substring scans
+KEYWORD_AUTOMATON = ahocorasick.Automaton()
+for _keyword in DIAGNOSTIC_KEYWORDS:
+    KEYWORD_AUTOMATON.add_word(_keyword, _keyword)
+KEYWORD_AUTOMATON.make_automaton()
+del _keyword
+
+# Quotes and emoji never carry diagnostic meaning; normalize_diagnosis drops them
+# in a single translate call
+_STRIP_TBL = str.maketrans(
+    {ch: None for ch in "\"'`\u2018\u2019\u201c\u201d"}
+    | {cp: None for cp in range(0x2600, 0x27C0)}      # Misc symbols and dingbats
+    | {cp: None for cp in range(0x1F300, 0x1FB00)}    # Emoji and pictographs
+    | {0xFE0F: None, 0x200D: None}                    # Emoji variation selector and joiner
+)
+
+
+def _scan_keywords(text_lower):
+    """Return the diagnostic keywords present in already-lowercased text, in list order"""
+    found = {keyword for _, keyword in KEYWORD_AUTOMATON.iter(text_lower)}
+    
+    # Preserve the keyword list order so ties rank the same as before
+    return [keyword for keyword in DIAGNOSTIC_KEYWORDS if keyword in found]
+
+
+@dataclass(slots=True)
+class YTDoc:
+    """YouTube text (title, description, comment or transcript) processed once at ingest"""
+    id: str
+    text: str
+    lower: str
+    keywords: tuple
+    tokens: list = field(default_factory=list)
+    
+    @classmethod
+    def from_text(cls, doc_id, text, tokens=None):
+        """Lowercase and keyword-scan text a single time"""
+        text = text or ""
+        lower = text.lower()
+        keywords = tuple(_scan_keywords(lower))
+        
+        return cls(doc_id, text, lower, keywords, tokens if tokens is not None else [])
+
 
 class VehicleSpecificationChecker:
     """Check vehicle specifications to filter impossible diagnoses"""
@@ -27,43 +98,39 @@ class VehicleSpecificationChecker:
         'Nissan': ['Juke', 'Sentra', 'Altima']
     }
     
+    # Lowercased once at class load so lookups don't re-lower every model per call
+    TURBO_MODELS_LC = {
+        manufacturer: tuple(m.lower() for m in models)
+        for manufacturer, models in TURBO_MODELS.items()
+    }
+    
+    # Manufacturers that went (mostly) turbo from 2016 onwards
+    TURBO_BRANDS_2016 = frozenset(['BMW', 'Audi', 'Mercedes-Benz', 'Volkswagen'])
+    
+    TURBO_KEYWORD_RE = re.compile(r"turbo|tsi|tfsi|ecoboost|tdi|gti")
+    DIESEL_KEYWORD_RE = re.compile(r"diesel|tdi|d|dci|hdi|crdi")
+    
     @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def has_turbo(manufacturer, model, year):
         """Check if vehicle likely has turbocharger"""
         # After 2016, many manufacturers added turbos
-        if year >= 2016:
-            if manufacturer in ['BMW', 'Audi', 'Mercedes-Benz', 'Volkswagen']:
-                return True
-        
-        # Check specific models
-        if manufacturer in VehicleSpecificationChecker.TURBO_MODELS:
-            model_list = VehicleSpecificationChecker.TURBO_MODELS[manufacturer]
-            model_lower = model.lower()
-            
-            for turbo_model in model_list:
-                if turbo_model.lower() in model_lower:
-                    return True
+        if year >= 2016 and manufacturer in VehicleSpecificationChecker.TURBO_BRANDS_2016:
+            return True
         
-        # Keywords in model name
-        turbo_keywords = ['turbo', 'tsi', 'tfsi', 'ecoboost', 'tdi', 'gti']
+        # Check specific models, then keywords in model name
         model_lower = model.lower()
-        for keyword in turbo_keywords:
-            if keyword in model_lower:
-                return True
+        turbo_models = VehicleSpecificationChecker.TURBO_MODELS_LC.get(manufacturer, ())
+        if any(turbo_model in model_lower for turbo_model in turbo_models):
+            return True
         
-        return False
+        return bool(VehicleSpecificationChecker.TURBO_KEYWORD_RE.search(model_lower))
     
     @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def has_diesel(manufacturer, model, year):
         """Check if vehicle is diesel"""
-        diesel_keywords = ['diesel', 'tdi', 'd', 'dci', 'hdi', 'crdi']
-        model_lower = model.lower()
-        
-        for keyword in diesel_keywords:
-            if keyword in model_lower:
-                return True
-        
-        return False
+        return bool(VehicleSpecificationChecker.DIESEL_KEYWORD_RE.search(model.lower()))
     
     @staticmethod
     def filter_diagnosis(diagnosis, manufacturer, model, year):
@@ -98,38 +165,22 @@ class DiagnosisAggregator:
         if not text:
             return []
         
-        text_lower = text.lower()
-        
-        # Common diagnostic keywords (expanded with more specific components)
-        keywords = [
-            'brake', 'brakes', 'pad', 'pads', 'rotor', 'rotors', 'caliper',
-            'bearing', 'bearings', 'wheel bearing', 'hub bearing',
-            'belt', 'serpentine', 'serpentine belt', 'timing belt', 'timing chain',
-            'exhaust', 'muffler', 'catalytic converter', 'manifold',
-            'suspension', 'shock', 'shocks', 'strut', 'struts', 'strut mount',
-            'engine', 'motor', 'piston', 'cylinder',
-            'transmission', 'gearbox', 'clutch',
-            'turbo', 'turbocharger', 'wastegate', 'boost',
-            'alternator', 'starter', 'battery',
-            'pulley', 'idler', 'tensioner', 'timing chain tensioner',
-            'mount', 'engine mount', 'motor mount', 'transmission mount',
-            'cv joint', 'cv axle', 'axle', 'driveshaft',
-            'tire', 'tires', 'wheel',
-            'leak', 'leaking', 'fluid',
-            'worn', 'wear', 'damage', 'damaged',
-            'loose', 'broken', 'cracked',
-            'misfire', 'ignition', 'spark plug', 'coil',
-            'sway bar', 'ball joint', 'tie rod', 'control arm',
-            'power steering', 'rack and pinion', 'steering',
-            'vanos', 'variable valve timing', 'vvt'
-        ]
+        if isinstance(text, YTDoc):
+            return list(text.keywords)
         
-        found_keywords = []
-        for keyword in keywords:
-            if keyword in text_lower:
-                found_keywords.append(keyword)
-        
-        return found_keywords
+        return _scan_keywords(text.lower())
+    
+    @staticmethod
+    def extract_keywords_into(text, counter, weight=1):
+        """Count diagnostic keywords found in text (or a YTDoc) straight into counter"""
+        for keyword in DiagnosisAggregator.extract_keywords(text):
+            counter[keyword] += weight
+    
+    @staticmethod
+    def scan_corpus_into(corpus, counter, weight=1):
+        """Count diagnostic keywords across every document of a corpus into counter"""
+        for doc in corpus:
+            DiagnosisAggregator.extract_keywords_into(doc, counter, weight)
     
     @staticmethod
     def normalize_diagnosis(diagnosis):
@@ -137,11 +188,11 @@ class DiagnosisAggregator:
         if not diagnosis:
             return ""
         
-        # Convert to lowercase
-        normalized = diagnosis.lower()
+        # Convert to lowercase (YTDocs were lowercased at ingest)
+        normalized = diagnosis.lower if isinstance(diagnosis, YTDoc) else diagnosis.lower()
         
-        # Remove extra spaces
-        normalized = ' '.join(normalized.split())
+        # Strip quotes/emoji, then remove extra spaces
+        normalized = ' '.join(normalized.translate(_STRIP_TBL).split())
         
         return normalized
     
@@ -158,64 +209,51 @@ class DiagnosisAggregator:
         """
         Aggregate all diagnosis sources and find common denominator
         
+        YouTube sources may be lists of strings or of YTDoc records; YTDocs reuse
+        the keywords and lowercased text computed at ingest.
+        
         Returns:
             dict with diagnosis, confidence, and sources
         """
-        all_keywords = []
+        keyword_counter = Counter()
         all_diagnoses = []
         sources = []
         
-        # Extract from YouTube video titles
-        if youtube_titles:
-            for title in youtube_titles:
-                keywords = DiagnosisAggregator.extract_keywords(title)
-                all_keywords.extend(keywords)
-                all_diagnoses.append(DiagnosisAggregator.normalize_diagnosis(title))
-            sources.append(f"YouTube titles ({len(youtube_titles)})")
-            logger.info(f"Processed {len(youtube_titles)} YouTube titles")
-        
-        # Extract from YouTube descriptions
-        if youtube_descriptions:
-            for desc in youtube_descriptions:
-                keywords = DiagnosisAggregator.extract_keywords(desc)
-                all_keywords.extend(keywords)
-                all_diagnoses.append(DiagnosisAggregator.normalize_diagnosis(desc))
-            sources.append(f"YouTube descriptions ({len(youtube_descriptions)})")
-            logger.info(f"Processed {len(youtube_descriptions)} YouTube descriptions")
-        
-        # Extract from YouTube comments
-        if youtube_comments:
-            for comment in youtube_comments:
-                keywords = DiagnosisAggregator.extract_keywords(comment)
-                all_keywords.extend(keywords)
-            sources.append(f"YouTube comments ({len(youtube_comments)})")
-            logger.info(f"Processed {len(youtube_comments)} YouTube comments")
-        
-        # Extract from YouTube transcripts
-        if youtube_transcripts:
-            for transcript in youtube_transcripts:
-                keywords = DiagnosisAggregator.extract_keywords(transcript)
-                all_keywords.extend(keywords)
-            sources.append(f"YouTube transcripts ({len(youtube_transcripts)})")
-            logger.info(f"Processed {len(youtube_transcripts)} YouTube transcripts")
+        # Scan each YouTube corpus in turn; titles and descriptions also feed the
+        # normalized diagnosis list
+        youtube_sources = (
+            (youtube_titles, "titles", True),
+            (youtube_descriptions, "descriptions", True),
+            (youtube_comments, "comments", False),
+            (youtube_transcripts, "transcripts", False),
+        )
+        for corpus, label, keep_diagnoses in youtube_sources:
+            if not corpus:
+                continue
+            
+            DiagnosisAggregator.scan_corpus_into(corpus, keyword_counter)
+            if keep_diagnoses:
+                all_diagnoses.extend(DiagnosisAggregator.normalize_diagnosis(doc) for doc in corpus)
+            sources.append(f"YouTube {label} ({len(corpus)})")
+            logger.info(f"Processed {len(corpus)} YouTube {label}")
         
         # Add spectrogram match result
         if spectrogram_match:
-            keywords = DiagnosisAggregator.extract_keywords(spectrogram_match)
-            all_keywords.extend(keywords * 2)  # Weight spectrogram higher
+            # Weight spectrogram higher
+            DiagnosisAggregator.extract_keywords_into(spectrogram_match, keyword_counter, weight=2)
             all_diagnoses.append(DiagnosisAggregator.normalize_diagnosis(spectrogram_match))
             sources.append("Spectrogram match")
             logger.info("Added spectrogram match result")
         
         # Add AI diagnosis
         if ai_diagnosis:
-            keywords = DiagnosisAggregator.extract_keywords(ai_diagnosis)
-            all_keywords.extend(keywords * 2)  # Weight AI higher
+            # Weight AI higher
+            DiagnosisAggregator.extract_keywords_into(ai_diagnosis, keyword_counter, weight=2)
             all_diagnoses.append(DiagnosisAggregator.normalize_diagnosis(ai_diagnosis))
             sources.append("AI analysis")
             logger.info("Added AI diagnosis")
         
-        if not all_keywords:
+        if not keyword_counter:
             logger.warning("No diagnostic keywords found from any source")
             return {
                 'diagnosis': 'Unable to determine issue - insufficient data',
@@ -224,8 +262,7 @@ class DiagnosisAggregator:
                 'keywords': []
             }
         
-        # Count keyword frequency
-        keyword_counter = Counter(all_keywords)
+        # Keyword frequencies were counted while scanning each source
         most_common_keywords = keyword_counter.most_common(5)
         
         logger.info(f"Most common keywords: {most_common_keywords}")
@@ -272,5 +309,6 @@ class DiagnosisAggregator:
             'confidence': round(confidence, 2),
             'sources': sources,
             'keywords': [k for k, _ in most_common_keywords],
-            'keyword_counts': dict(most_common_keywords)
+            'keyword_counts': dict(most_common_keywords),
+            'total_mentions': total_mentions
         }
@@ -1,29 +1,128 @@
 # youtube_helper.py
+import asyncio
 import yt_dlp
 import os
 from pathlib import Path
 import logging
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import weakref
+import ijson
+import itertools
+import requests
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from diskcache import Cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
-TEMP_DIR = Path('./temp_videos')
-TEMP_DIR.mkdir(exist_ok=True)
+CACHE_ROOT = Path('./temp_videos')
+CACHE_ROOT.mkdir(exist_ok=True)
+
+# Downloaded audio is short-lived, so stage it in RAM (tmpfs) when there's room
+TMPFS_DIR = Path('/dev/shm')
+TMPFS_MIN_FREE_BYTES = 2 * 1024 ** 3
+
+
+def _pick_temp_dir():
+    """Use a tmpfs directory for downloads if writable with enough free space, else disk"""
+    try:
+        if (TMPFS_DIR.is_dir() and os.access(TMPFS_DIR, os.W_OK)
+                and shutil.disk_usage(TMPFS_DIR).free >= TMPFS_MIN_FREE_BYTES):
+            return TMPFS_DIR / 'autodecx_videos'
+    except OSError:
+        pass
+    return CACHE_ROOT
+
+
+TEMP_DIR = _pick_temp_dir()
+TEMP_DIR.mkdir(exist_ok=True, parents=True)
+_TEMP_DIR_STR = str(TEMP_DIR)  # For os-level calls on the hot paths
+
+# Search results and video metadata are cached on disk (shared by all workers)
+# so repeat queries for the same vehicle skip the YouTube round-trips
+CACHE_TTL_SECONDS = 86400
+_cache = Cache(str(CACHE_ROOT / '.search_cache'))
+
+# yt-dlp's own cache (player JS, nsig functions) survives across YoutubeDL instances
+YTDLP_CACHE_DIR = CACHE_ROOT / '.ytdlp_cache'
+
+# Pooled keep-alive session for caption fetches, shared by all download threads
+_HTTP = requests.Session()
+_HTTP.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+))
+_HTTP.headers.update({'Accept-Encoding': 'gzip'})
+
+# Caption segments are streamed and cut off here; transcripts only feed a short prompt excerpt
+CAPTION_MAX_SEGMENTS = 10000
+
+# ffmpeg writes WAV at the rate audio_matcher.extract_audio_features loads at, in mono
+AUDIO_SAMPLE_RATE = 22050
+
+# Concurrent video downloads. Every search result is a youtube.com watch page, so
+# this is also the limit on concurrent requests to YouTube.
+MAX_PARALLEL_DOWNLOADS = 8
+
+# Abandon a media stream that stays below this speed for this long, so a throttled
+# video frees its download slot instead of trickling in
+MIN_DOWNLOAD_SPEED = 100_000  # bytes/s
+SLOW_DOWNLOAD_GRACE_SECONDS = 15
+
+
+class SlowDownloadError(Exception):
+    """Raised from a yt-dlp progress hook to abandon a stream that stays too slow"""
+
+
+# Time each in-flight download first dropped below MIN_DOWNLOAD_SPEED, keyed by temp file
+_slow_since = {}
+
+
+def _abort_slow_downloads(d):
+    """yt-dlp progress hook: raise SlowDownloadError once a download has been slow too long"""
+    key = d.get('tmpfilename') or d.get('filename')
+    speed = d.get('speed')
+    
+    if d['status'] != 'downloading' or speed is None or speed >= MIN_DOWNLOAD_SPEED:
+        _slow_since.pop(key, None)
+        return
+    
+    now = time.monotonic()
+    if now - _slow_since.setdefault(key, now) >= SLOW_DOWNLOAD_GRACE_SECONDS:
+        _slow_since.pop(key, None)
+        raise SlowDownloadError(
+            f"below {MIN_DOWNLOAD_SPEED} B/s for {SLOW_DOWNLOAD_GRACE_SECONDS}s, giving up"
+        )
+
+
+# Search results with fewer views than this are rarely useful diagnosis videos
+MIN_VIEW_COUNT = 100
+
+# Per-thread YoutubeDL instances shared by every downloader (see _get_ydl)
+_ydl_local = threading.local()
 
 class YouTubeAudioDownloader:
     """
     Download audio from YouTube videos for vehicle sound comparison
     """
     
-    def __init__(self, max_videos=15, max_duration=180):
+    # Extensions yt-dlp/ffmpeg may leave the downloaded audio with
+    _AUDIO_EXTS = frozenset(('wav', 'm4a', 'webm', 'opus', 'mp3', 'aac'))
+    
+    def __init__(self, max_videos=15, max_duration=180, accept_compressed=False):
         """
         Args:
             max_videos: Maximum number of videos to download (increased to 15)
             max_duration: Maximum video duration in seconds (default: 3 minutes)
+            accept_compressed: Keep opus/m4a audio as downloaded instead of converting to WAV
         """
         self.max_videos = max_videos
         self.max_duration = max_duration
+        self.accept_compressed = accept_compressed
         
         # yt-dlp options for audio-only download
         self.ydl_opts = {
@@ -33,15 +132,98 @@ class YouTubeAudioDownloader:
                 'preferredcodec': 'wav',
                 'preferredquality': '192',
             }],
-            'outtmpl': str(TEMP_DIR / '%(id)s.%(ext)s'),
+            'postprocessor_args': {'extractaudio': ['-ac', '1', '-ar', str(AUDIO_SAMPLE_RATE)]},
+            'outtmpl': os.path.join(_TEMP_DIR_STR, '%(id)s.%(ext)s'),
+            'final_ext': 'wav',  # Lets yt-dlp recognise an already-converted file
             'cookiefile': '/app/youtube_cookies.txt',
             'quiet': True,
-            'extractor_args': {'youtube': {'player_client': ['android', 'web']}},
+            'extractor_args': {'youtube': {'player_client': ['android']}},
+            'youtube_include_dash_manifest': False,
+            'youtube_include_hls_manifest': False,
             'no_warnings': True,
             'extract_flat': False,
             'socket_timeout': 30,
+            'cachedir': str(YTDLP_CACHE_DIR),
+            'extractor_retries': 2,
+            'file_access_retries': 1,
+            # Abandon throttled streams (see _abort_slow_downloads) and cap yt-dlp's
+            # default 10 retries on failing ones so neither holds a download slot
+            'progress_hooks': [_abort_slow_downloads],
+            'retries': 2,
+            'fragment_retries': 2,
+        }
+        
+        if accept_compressed:
+            # Prefer opus/m4a streams; 'best' leaves common audio formats alone (or just
+            # remuxes them) so ffmpeg only re-encodes unusual codecs
+            self.ydl_opts['format'] = 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio/best'
+            self.ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'best',
+            }]
+            del self.ydl_opts['postprocessor_args']
+            del self.ydl_opts['final_ext']
+        
+        # yt-dlp options for flat search results
+        self.search_opts = {
+            'quiet': True,
+            'extractor_args': {'youtube': {'player_client': ['android']}},
+            'no_warnings': True,
+            'extract_flat': True,
+            'force_generic_extractor': False,
+            'cachedir': str(YTDLP_CACHE_DIR),
+            'extractor_retries': 2,
+            # yt-dlp drops long and barely-watched videos from the flat results itself
+            # (entries missing duration or view count pass)
+            'match_filter': yt_dlp.utils.match_filter_func(
+                f'duration <=? {max_duration} & view_count >? {MIN_VIEW_COUNT}'
+            ),
+        }
+        
+        # yt-dlp options for audio download plus metadata in the same pass -
+        # enable comment extraction explicitly
+        self.metadata_opts = {
+            **self.ydl_opts,
+            'getcomments': True,  # CRITICAL: Enable comment extraction
+            'extractor_args': {'youtube': {
+                'player_client': ['android'],
+                'comment_sort': ['top'],
+                'max_comments': ['15,15,15,0'],  # Top 15 threads, no reply pagination
+            }},
         }
     
+    def _get_ydl(self, opts_key):
+        """
+        Return this thread's YoutubeDL for an options set, creating it on first use
+        
+        Reusing the instance keeps extractor state, cookies and the HTTP opener
+        alive across videos instead of rebuilding them on every call. The cache is
+        module-wide, keyed by the settings that change the options, so downloaders
+        built per request share instances rather than each leaking their own.
+        
+        Args:
+            opts_key: 'download', 'search' or 'metadata' (download with comments)
+            
+        Returns:
+            yt_dlp.YoutubeDL instance
+        """
+        ydls = getattr(_ydl_local, 'ydls', None)
+        if ydls is None:
+            ydls = _ydl_local.ydls = {}
+        
+        key = (opts_key, self.max_duration, self.accept_compressed)
+        ydl = ydls.get(key)
+        if ydl is None:
+            opts = {
+                'download': self.ydl_opts,
+                'search': self.search_opts,
+                'metadata': self.metadata_opts,
+            }[opts_key]
+            ydl = ydls[key] = yt_dlp.YoutubeDL(opts)
+            # Close (and save cookies) once the worker thread goes away
+            weakref.finalize(threading.current_thread(), ydl.close)
+        return ydl
+    
     def search_videos(self, query, max_results=10):
         """
         Search YouTube for relevant videos using yt-dlp
@@ -53,60 +235,108 @@ class YouTubeAudioDownloader:
         Returns:
             List of video info dicts
         """
-        logger.info(f"Searching YouTube for: '{query}'")
+        logger.info("Searching YouTube for: '%s'", query)
         
         try:
-            # Use yt-dlp to search YouTube
-            ydl_search_opts = {
-                'quiet': True,
-            'extractor_args': {'youtube': {'player_client': ['android', 'web']}},
-                'no_warnings': True,
-                'extract_flat': True,
-                'force_generic_extractor': False,
+            # Only non-empty results are cached, so one empty or malformed response
+            # doesn't hide this query for the whole TTL
+            search_key = ('search', query, max_results, self.max_duration, self.max_videos)
+            videos = _cache.get(search_key)
+            if videos is None:
+                videos = self._search_filtered(query, max_results, self.max_duration, self.max_videos)
+                if videos:
+                    _cache.set(search_key, videos, expire=CACHE_TTL_SECONDS)
+            return videos
+        
+        except Exception as e:
+            logger.error("YouTube search error: %s", e)
+            return []
+    
+    def _search_filtered(self, query, max_results, max_duration, max_videos):
+        """
+        Run a YouTube search filtered to the duration and view limits
+        
+        Args:
+            query: Search query string
+            max_results: Maximum number of search results
+            max_duration: Maximum video duration in seconds
+            max_videos: Maximum number of videos to keep
+            
+        Returns:
+            List of video info dicts
+        """
+        search_url = f"ytsearch{max_results}:{query}"
+        
+        # Use yt-dlp to search YouTube
+        ydl = self._get_ydl('search')
+        search_results = ydl.extract_info(search_url, download=False)
+        
+        if not search_results or 'entries' not in search_results:
+            logger.warning("No results found for query: %s", query)
+            return []
+        
+        videos = []
+        for entry in search_results['entries']:
+            if not entry:
+                continue
+            
+            # Long and low-view videos were already dropped by match_filter
+            duration_seconds = entry.get('duration', 0)
+            
+            video_info = {
+                'id': entry.get('id'),
+                'title': entry.get('title'),
+                'url': f"https://youtube.com/watch?v={entry.get('id')}",
+                'channel': entry.get('channel', entry.get('uploader', 'Unknown')),
+                'duration': duration_seconds,
+                'views': entry.get('view_count', 0)
             }
             
-            search_url = f"ytsearch{max_results}:{query}"
+            videos.append(video_info)
             
-            with yt_dlp.YoutubeDL(ydl_search_opts) as ydl:
-                search_results = ydl.extract_info(search_url, download=False)
-                
-                if not search_results or 'entries' not in search_results:
-                    logger.warning(f"No results found for query: {query}")
-                    return []
-                
-                videos = []
-                for entry in search_results['entries']:
-                    if not entry:
-                        continue
-                    
-                    # Get duration in seconds
-                    duration_seconds = entry.get('duration', 0)
-                    
-                    # Skip videos longer than max_duration
-                    if duration_seconds > self.max_duration:
-                        logger.info(f"Skipping long video: {entry.get('title')} ({duration_seconds}s)")
-                        continue
-                    
-                    video_info = {
-                        'id': entry.get('id'),
-                        'title': entry.get('title'),
-                        'url': f"https://youtube.com/watch?v={entry.get('id')}",
-                        'channel': entry.get('channel', entry.get('uploader', 'Unknown')),
-                        'duration': duration_seconds,
-                        'views': entry.get('view_count', 0)
-                    }
-                    
-                    videos.append(video_info)
-                    
-                    if len(videos) >= self.max_videos:
-                        break
-                
-                logger.info(f"Found {len(videos)} suitable videos")
-                return videos
+            if len(videos) >= max_videos:
+                break
         
-        except Exception as e:
-            logger.error(f"YouTube search error: {str(e)}")
-            return []
+        logger.info("Found %d suitable videos", len(videos))
+        return videos
+    
+    def _downloaded_path(self, info, video_id):
+        """
+        Final audio path for a download, taken from the info dict yt-dlp returned
+        
+        Args:
+            info: Info dict from extract_info(download=True)
+            video_id: Unique video identifier
+            
+        Returns:
+            Path to the audio file or None
+        """
+        downloads = (info or {}).get('requested_downloads')
+        if downloads and downloads[0].get('filepath'):
+            return Path(downloads[0]['filepath'])
+        
+        # Older/unusual results don't report the file - look for it instead
+        return self._find_downloaded(video_id)
+    
+    def _find_downloaded(self, video_id):
+        """
+        Locate a video's downloaded audio with a single scan of TEMP_DIR
+        
+        Args:
+            video_id: Unique video identifier
+            
+        Returns:
+            Path to the audio file (WAV preferred) or None
+        """
+        found = None
+        with os.scandir(_TEMP_DIR_STR) as it:
+            for entry in it:
+                stem, _, ext = entry.name.rpartition('.')
+                if stem == video_id and ext in self._AUDIO_EXTS:
+                    if ext == 'wav':
+                        return Path(entry.path)
+                    found = found or Path(entry.path)
+        return found
     
     def download_audio(self, video_url, video_id):
         """
@@ -120,149 +350,193 @@ class YouTubeAudioDownloader:
             Path to downloaded audio file or None
         """
         try:
-            logger.info(f"Downloading audio from: {video_url}")
+            logger.info("Downloading audio from: %s", video_url)
             
-            with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                info = ydl.extract_info(video_url, download=True)
-                
-                # Find the downloaded file
-                audio_file = TEMP_DIR / f"{video_id}.wav"
-                
-                if audio_file.exists():
-                    logger.info(f"✅ Downloaded: {audio_file}")
-                    return audio_file
-                else:
-                    # Sometimes the file has a different extension
-                    for ext in ['.wav', '.m4a', '.webm', '.opus']:
-                        alt_file = TEMP_DIR / f"{video_id}{ext}"
-                        if alt_file.exists():
-                            logger.info(f"✅ Downloaded: {alt_file}")
-                            return alt_file
-                    
-                    logger.error(f"Audio file not found after download: {video_id}")
-                    return None
+            ydl = self._get_ydl('download')
+            info = ydl.extract_info(video_url, download=True)
+            
+            # Find the downloaded file
+            audio_file = self._downloaded_path(info, video_id)
+            
+            if audio_file:
+                logger.info("✅ Downloaded: %s", audio_file)
+                return audio_file
+            
+            logger.error("Audio file not found after download: %s", video_id)
+            return None
         
         except Exception as e:
-            logger.error(f"Download error for {video_url}: {str(e)}")
+            logger.error("Download error for %s: %s", video_url, e)
             return None
     
+    def download_batch(self, videos):
+        """
+        Download audio (no metadata) from multiple videos in one yt-dlp invocation
+        
+        A single YoutubeDL.download() call shares cookies and the player/signature
+        caches across every URL instead of warming them up once per video.
+        
+        Args:
+            videos: List of video info dicts
+            
+        Returns:
+            List of tuples: (video_info, audio_file_path)
+        """
+        logger.info("Starting batch download of %d videos", len(videos))
+        start_time = time.time()
+        
+        audio_files = {}
+        running = set()
+        
+        def _postprocessed(d):
+            # MoveFiles runs last, after FFmpeg, and also for files that were already
+            # on disk, so its filepath is the final converted audio. ignoreerrors lets
+            # it run after a failed conversion too, which then never reports 'finished'.
+            step = (d['info_dict']['id'], d['postprocessor'])
+            if d['status'] == 'started':
+                running.add(step)
+            elif d['status'] == 'finished':
+                running.discard(step)
+                if step[1] == 'MoveFiles' and not any(vid == step[0] for vid, _ in running):
+                    audio_files[step[0]] = Path(d['info_dict']['filepath'])
+        
+        batch_opts = {
+            **self.ydl_opts,
+            'concurrent_fragment_downloads': 4,
+            'ignoreerrors': True,  # One unavailable video shouldn't abort the batch
+            'postprocessor_hooks': [_postprocessed],
+        }
+        
+        try:
+            with yt_dlp.YoutubeDL(batch_opts) as ydl:
+                ydl.download([video['url'] for video in videos])
+        except Exception as e:
+            logger.error("Batch download error: %s", e)
+        
+        results = [(video, audio_files[video['id']]) for video in videos if video['id'] in audio_files]
+        
+        elapsed = time.time() - start_time
+        logger.info("Downloaded %d/%d videos in %.2fs", len(results), len(videos), elapsed)
+        
+        return results
+    
 
-    def download_audio_with_metadata(self, video_url, video_id):
+    def download_audio_with_metadata(self, video_url, video_id, need_comments=False):
         """
         Download audio AND extract comprehensive metadata from YouTube video
         
         Args:
             video_url: YouTube video URL
             video_id: Unique video identifier
+            need_comments: Also fetch the top comments (costs extra Innertube requests)
             
         Returns:
             Tuple: (audio_file_path, metadata_dict) or (None, None)
         """
         try:
-            logger.info(f"Downloading audio and metadata from: {video_url}")
+            logger.info("Downloading audio and metadata from: %s", video_url)
             
-            # Extract info without downloading first to get metadata
-            # Enable comment extraction explicitly
-            metadata_opts = {
-                'quiet': True, 
-                'cookiefile': '/app/youtube_cookies.txt',
-                'getcomments': True,  # CRITICAL: Enable comment extraction
-                'extractor_args': {'youtube': {'comment_sort': ['top'], 'max_comments': ['15,all,15,0']}},
-            }
-            with yt_dlp.YoutubeDL(metadata_opts) as ydl:
-                info = ydl.extract_info(video_url, download=False)
-                
-                # Extract metadata
-                metadata = {
-                    'title': info.get('title', 'Unknown'),
-                    'description': info.get('description', ''),
-                    'channel': info.get('uploader', info.get('channel', 'Unknown')),
-                    'duration': info.get('duration', 0),
-                    'view_count': info.get('view_count', 0),
-                    'like_count': info.get('like_count', 0),
-                    'tags': info.get('tags', []),
-                    'categories': info.get('categories', []),
-                    'subtitles': [],
-                    'comments': []
-                }
-                
-                # Extract automatic captions (subtitles)
-                if 'automatic_captions' in info and info['automatic_captions']:
-                    # Try to get English captions
-                    if 'en' in info['automatic_captions']:
-                        caption_url = None
-                        for caption in info['automatic_captions']['en']:
-                            if caption.get('ext') == 'json3':
-                                caption_url = caption.get('url')
-                                break
-                        
-                        if caption_url:
-                            try:
-                                import requests
-                                import json
-                                response = requests.get(caption_url, timeout=10)
-                                if response.ok:
-                                    caption_data = response.json()
-                                    # Extract text from caption events
-                                    caption_text = []
-                                    if 'events' in caption_data:
-                                        for event in caption_data['events']:
-                                            if 'segs' in event:
-                                                for seg in event['segs']:
-                                                    if 'utf8' in seg:
-                                                        caption_text.append(seg['utf8'])
-                                    metadata['subtitles'] = caption_text
-                                    logger.info(f"✅ Extracted {len(caption_text)} caption segments")
-                            except Exception as e:
-                                logger.warning(f"Could not extract captions: {e}")
-                
-                # Extract top comments (if available) - FIRST 15 COMMENTS
-                if 'comments' in info and info['comments']:
-                    top_comments = []
-                    for comment in info['comments'][:15]:  # Top 15 comments as requested
-                        comment_text = comment.get('text', '')
-                        author = comment.get('author', 'Unknown')
-                        likes = comment.get('like_count', 0)
-                        if comment_text:
-                            top_comments.append({
-                                'author': author,
-                                'text': comment_text,
-                                'likes': likes
-                            })
-                    metadata['comments'] = top_comments
-                    logger.info(f"✅ Extracted {len(top_comments)} comments")
-                else:
-                    logger.warning("⚠️  No comments available for this video")
+            # One extractor pass downloads the audio and, when requested and this
+            # video's metadata isn't already cached, its comments too
+            metadata_key = ('metadata', video_url, need_comments)
+            metadata = _cache.get(metadata_key)
             
-            # Now download audio with original options
-            with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                ydl.download([video_url])
-                
-                # Find the downloaded file
-                audio_file = TEMP_DIR / f"{video_id}.wav"
-                
-                if audio_file.exists():
-                    logger.info(f"✅ Downloaded audio: {audio_file}")
-                    return audio_file, metadata
-                else:
-                    # Check alternative extensions
-                    for ext in ['.wav', '.m4a', '.webm', '.opus']:
-                        alt_file = TEMP_DIR / f"{video_id}{ext}"
-                        if alt_file.exists():
-                            logger.info(f"✅ Downloaded audio: {alt_file}")
-                            return alt_file, metadata
-                    
-                    logger.error(f"Audio file not found after download: {video_id}")
-                    return None, None
+            ydl = self._get_ydl('metadata' if need_comments and metadata is None else 'download')
+            info = ydl.extract_info(video_url, download=True)
+            
+            if metadata is None:
+                metadata = self._extract_metadata(info)
+                _cache.set(metadata_key, metadata, expire=CACHE_TTL_SECONDS)
+            
+            # Find the downloaded file
+            audio_file = self._downloaded_path(info, video_id)
+            
+            if audio_file:
+                logger.info("✅ Downloaded audio: %s", audio_file)
+                return audio_file, metadata
+            
+            logger.error("Audio file not found after download: %s", video_id)
+            return None, None
         
         except Exception as e:
-            logger.error(f"Download error for {video_url}: {str(e)}")
+            logger.error("Download error for %s: %s", video_url, e)
             return None, None
 
 
-    def download_multiple(self, videos):
+    def _extract_metadata(self, info):
         """
-        Download audio from multiple videos in parallel WITH metadata
+        Extract title, description, captions and top comments from a video's info dict
+        
+        Args:
+            info: yt-dlp info dict (comments present only if extracted with them)
+            
+        Returns:
+            Dict: Video metadata
+        """
+        # Extract metadata
+        metadata = {
+            'title': info.get('title', 'Unknown'),
+            'description': info.get('description', ''),
+            'channel': info.get('uploader', info.get('channel', 'Unknown')),
+            'duration': info.get('duration', 0),
+            'view_count': info.get('view_count', 0),
+            'like_count': info.get('like_count', 0),
+            'tags': info.get('tags', []),
+            'categories': info.get('categories', []),
+            'subtitles': [],
+            'comments': []
+        }
+        
+        # Extract automatic captions (subtitles)
+        if 'automatic_captions' in info and info['automatic_captions']:
+            # Try to get English captions
+            if 'en' in info['automatic_captions']:
+                caption_url = None
+                for caption in info['automatic_captions']['en']:
+                    if caption.get('ext') == 'json3':
+                        caption_url = caption.get('url')
+                        break
+                
+                if caption_url:
+                    try:
+                        with _HTTP.get(caption_url, timeout=10, stream=True) as response:
+                            if response.ok:
+                                # Stream text out of caption events as bytes arrive
+                                response.raw.decode_content = True
+                                segments = ijson.items(response.raw, 'events.item.segs.item.utf8')
+                                caption_text = list(itertools.islice(segments, CAPTION_MAX_SEGMENTS))
+                                metadata['subtitles'] = caption_text
+                                logger.info("✅ Extracted %d caption segments", len(caption_text))
+                    except Exception as e:
+                        logger.warning("Could not extract captions: %s", e)
+        
+        # Extract top comments (if available) - FIRST 15 COMMENTS
+        if 'comments' in info and info['comments']:
+            top_comments = []
+            for comment in info['comments'][:15]:  # Top 15 comments as requested
+                comment_text = comment.get('text', '')
+                author = comment.get('author', 'Unknown')
+                likes = comment.get('like_count', 0)
+                if comment_text:
+                    top_comments.append({
+                        'author': author,
+                        'text': comment_text,
+                        'likes': likes
+                    })
+            metadata['comments'] = top_comments
+            logger.info("✅ Extracted %d comments", len(top_comments))
+        elif 'comments' in info:  # Comment extraction ran but found nothing
+            logger.warning("⚠️  No comments available for this video")
+        
+        return metadata
+    
+
+    async def download_multiple_async(self, videos):
+        """
+        Download audio from multiple videos concurrently WITH metadata
+        
+        Each download runs in a worker thread; one semaphore caps parallelism at
+        MAX_PARALLEL_DOWNLOADS, which is also the cap on concurrent YouTube requests.
         
         Args:
             videos: List of video info dicts
@@ -270,42 +544,76 @@ class YouTubeAudioDownloader:
         Returns:
             List of tuples: (video_info, audio_file_path, metadata_dict)
         """
-        logger.info(f"Starting parallel download of {len(videos)} videos with metadata")
+        logger.info("Starting parallel download of %d videos with metadata", len(videos))
         
         results = []
         start_time = time.time()
         
-        # Use ThreadPoolExecutor for parallel downloads
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_video = {
-                executor.submit(self.download_audio_with_metadata, video['url'], video['id']): video
-                for video in videos
-            }
-            
-            for future in as_completed(future_to_video):
-                video = future_to_video[future]
+        sem = asyncio.Semaphore(MAX_PARALLEL_DOWNLOADS)
+        
+        async def _one(video):
+            async with sem:
                 try:
-                    result = future.result()
-                    if result and result[0]:  # If audio_path exists
-                        audio_path, metadata = result
-                        results.append((video, audio_path, metadata))
-                        logger.info(f"✅ Downloaded {len(results)}/{len(videos)} (with metadata)")
+                    audio_path, metadata = await asyncio.to_thread(
+                        self.download_audio_with_metadata, video['url'], video['id'], need_comments=True
+                    )
                 except Exception as e:
-                    logger.error(f"Failed to download {video['title']}: {str(e)}")
+                    logger.error("Failed to download %s: %s", video['title'], e)
+                    return
+            
+            if audio_path:
+                results.append((video, audio_path, metadata))
+                logger.info("✅ Downloaded %d/%d (with metadata)", len(results), len(videos))
+        
+        await asyncio.gather(*(_one(video) for video in videos))
         
         elapsed = time.time() - start_time
-        logger.info(f"Downloaded {len(results)} videos with metadata in {elapsed:.2f}s")
+        logger.info("Downloaded %d videos with metadata in %.2fs", len(results), elapsed)
         
         return results
     
+    def download_multiple(self, videos):
+        """
+        Download audio from multiple videos in parallel WITH metadata
+        
+        Synchronous wrapper around download_multiple_async for the Flask handlers.
+        
+        Args:
+            videos: List of video info dicts
+            
+        Returns:
+            List of tuples: (video_info, audio_file_path, metadata_dict)
+        """
+        async def _run():
+            # Size the to_thread pool to the download limit rather than the CPU count
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS)
+            )
+            return await self.download_multiple_async(videos)
+        
+        return asyncio.run(_run())
+    
     def cleanup_temp_files(self):
         """Delete all temporary downloaded files"""
         try:
-            for file in TEMP_DIR.glob('*'):
-                file.unlink()
+            # Files only - leave the search and yt-dlp cache directories in place
+            with os.scandir(_TEMP_DIR_STR) as it:
+                paths = [entry.path for entry in it if entry.is_file()]
+            
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(os.unlink, paths))
             logger.info("🧹 Cleaned up temporary video files")
         except Exception as e:
-            logger.error(f"Cleanup error: {str(e)}")
+            logger.error("Cleanup error: %s", e)
+    
+    @classmethod
+    def clear_cache(cls):
+        """Delete all cached search results and video metadata"""
+        try:
+            _cache.clear()
+            logger.info("🧹 Cleared cached YouTube searches and metadata")
+        except Exception as e:
+            logger.error("Cache clear error: %s", e)
 
 
 def search_vehicle_issue_videos(manufacturer, year, model, location, max_videos=15, audio_description=None, occurrence=None):
@@ -338,18 +646,29 @@ def search_vehicle_issue_videos(manufacturer, year, model, location, max_videos=
     
     query = " ".join(filter(None, query_parts))
     
-    logger.info(f"🔍 Enhanced search query: {query}")
+    logger.info("🔍 Enhanced search query: %s", query)
     
     downloader = YouTubeAudioDownloader(max_videos=max_videos)
     
-    # Search for videos
-    videos = downloader.search_videos(query, max_results=15)
+    # Search with the specific and a broader fallback query at the same time so
+    # the fallback costs no extra latency when the specific query comes up empty
+    broad_query = f"{manufacturer} {model} {location} noise"
     
-    if not videos:
-        logger.warning("No videos found, trying broader search")
-        # Try broader query
-        query = f"{manufacturer} {model} {location} noise"
-        videos = downloader.search_videos(query, max_results=15)
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        specific_search = executor.submit(downloader.search_videos, query, max_results=15)
+        broad_search = executor.submit(downloader.search_videos, broad_query, max_results=15)
+        
+        videos = specific_search.result()
+        if not videos:
+            logger.warning("No videos found, using broader search")
+            videos = broad_search.result()
+    finally:
+        # Don't wait on the broad search if it isn't needed (it still warms the cache)
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    # Drop duplicate videos, keeping result order
+    videos = list({video['id']: video for video in videos}.values())
     
     if not videos:
         logger.error("No videos found even with broader search")